@@ -21,7 +21,6 @@ sys.path.insert(0, __import__("pathlib").Path(__file__).resolve().parent.as_posi
 from slack_common import (
     SLACK_CHANNEL_ID,
     ensure_thread,
-    get_thread_ts,
     get_transcript_file_id,
     log,
     post_message,
@@ -154,8 +153,7 @@ def main():
     comment = f"{emoji} {text}\n_Status: `{status}` | {timestamp}_"
 
     # Ensure thread exists, post stop notification as reply
-    post_message(comment, conversation_id, transcript_path=transcript_path)
-    thread_ts = get_thread_ts(conversation_id)
+    thread_ts = post_message(comment, conversation_id, transcript_path=transcript_path)
 
     # Upload/replace transcript on the thread root
     upload_transcript(transcript_path, status, timestamp, thread_ts, conversation_id)
@@ -1,156 +1,437 @@
 """Shared utilities for Cursor Slack hooks — API helpers + thread tracking."""
 
+import atexit
+import hashlib
+import http.client
 import json
 import os
+import socket
+import sqlite3
+import time
 import urllib.parse
-import urllib.request
-from datetime import datetime
 from pathlib import Path
 
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def json_loads(data):
+    """Parse JSON from str or bytes, using orjson when it's installed."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def json_dumps(obj):
+    """Serialize *obj* to UTF-8 JSON bytes, using orjson when it's installed."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode("utf-8")
+
+
 def _load_config():
     """Load credentials from config file, falling back to env vars."""
     config_file = Path.home() / ".cursor" / "hooks" / "state" / "config.json"
     token = os.environ.get("SLACK_BOT_TOKEN", "")
     channel = os.environ.get("SLACK_CHANNEL_ID", "")
+    app_token = os.environ.get("SLACK_APP_TOKEN", "")
     try:
-        cfg = json.loads(config_file.read_text())
+        cfg = json_loads(config_file.read_bytes())
         token = token or cfg.get("SLACK_BOT_TOKEN", "")
         channel = channel or cfg.get("SLACK_CHANNEL_ID", "")
+        app_token = app_token or cfg.get("SLACK_APP_TOKEN", "")
     except Exception:
         pass
-    return token, channel
+    return token, channel, app_token
 
-SLACK_BOT_TOKEN, SLACK_CHANNEL_ID = _load_config()
+SLACK_BOT_TOKEN, SLACK_CHANNEL_ID, SLACK_APP_TOKEN = _load_config()
 
 LOG = "/tmp/cursor-slack-hook.log"
-STATE_FILE = Path.home() / ".cursor" / "hooks" / "state" / "threads.json"
+STATE_DIR = Path.home() / ".cursor" / "hooks" / "state"
+STATE_DB = STATE_DIR / "threads.db"
+STATE_FILE = STATE_DIR / "threads.json"  # legacy, migrated into STATE_DB
+MAX_CONVERSATIONS = 100
+BOT_CACHE_FILE = STATE_DIR / "bot.json"
+
+
+def atomic_write(path, data):
+    """Write *data* (bytes) to *path* via a temp file + os.replace, so readers
+    never see a half-written file. Skips fsync — this state is regenerable.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+
+
+_LOG_FH = None  # line-buffered handle on LOG, opened on first use
+
+
+def _close_log():
+    if _LOG_FH is not None:
+        _LOG_FH.close()
+
+
+atexit.register(_close_log)
 
 
 def log(msg):
+    global _LOG_FH
+    line = f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] {msg}\n"
     try:
-        with open(LOG, "a") as f:
-            f.write(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {msg}\n")
+        # Reopen if the log was deleted or rotated out from under us
+        if _LOG_FH is not None and os.fstat(_LOG_FH.fileno()).st_nlink == 0:
+            _LOG_FH.close()
+            _LOG_FH = None
+        if _LOG_FH is None:
+            _LOG_FH = open(LOG, "a", buffering=1)
+        _LOG_FH.write(line)
     except Exception:
-        pass
+        _LOG_FH = None
+        try:
+            with open(LOG, "a") as f:
+                f.write(line)
+        except Exception:
+            pass
 
 
 # ---------------------------------------------------------------------------
 # Slack API helpers
 # ---------------------------------------------------------------------------
 
+class SlackRateLimited(Exception):
+    """Slack answered HTTP 429; wait *retry_after* seconds before retrying."""
+
+    def __init__(self, endpoint, retry_after):
+        super().__init__(f"{endpoint} rate limited; retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+# One keep-alive HTTPS connection per process, so back-to-back calls
+# (ensure_thread + post_message, the listener's poll loop) skip the TLS handshake.
+_CONN = None
+
+
+def _slack_request(endpoint, body, content_type):
+    """POST *body* to a Slack Web API endpoint over the shared connection.
+    Reconnects once if a reused connection was dropped by the server.
+    Returns the HTTPResponse, which must be read fully before the next call.
+    Raises SlackRateLimited on HTTP 429.
+    """
+    global _CONN
+    headers = {
+        "Content-Type": content_type,
+        "Authorization": f"Bearer {SLACK_BOT_TOKEN}",
+    }
+    for attempt in range(2):
+        reused = _CONN is not None
+        if not reused:
+            _CONN = http.client.HTTPSConnection("slack.com", timeout=15)
+        try:
+            _CONN.request("POST", f"/api/{endpoint}", body=body, headers=headers)
+            resp = _CONN.getresponse()
+            if resp.status == 429:
+                resp.read()
+                try:
+                    retry_after = int(resp.getheader("Retry-After", ""))
+                except ValueError:
+                    retry_after = 30
+                raise SlackRateLimited(endpoint, retry_after)
+            return resp
+        except socket.timeout:
+            # Don't retry — the request may already have been processed
+            _close_conn()
+            raise
+        except (http.client.HTTPException, OSError):
+            _close_conn()
+            if attempt or not reused:
+                raise
+
+
+def _close_conn():
+    global _CONN
+    if _CONN is not None:
+        _CONN.close()
+        _CONN = None
+
+
+def _slack_post(endpoint, body, content_type):
+    """POST to a Slack Web API endpoint. Returns parsed response."""
+    resp = _slack_request(endpoint, body, content_type)
+    try:
+        return json_loads(resp.read())
+    except Exception:
+        _close_conn()
+        raise
+
+
 def slack_api_json(endpoint, payload_dict):
     """POST JSON to a Slack Web API endpoint. Returns parsed response."""
-    data = json.dumps(payload_dict).encode("utf-8")
-    req = urllib.request.Request(
-        f"https://slack.com/api/{endpoint}",
-        data=data,
-        headers={
-            "Content-Type": "application/json; charset=utf-8",
-            "Authorization": f"Bearer {SLACK_BOT_TOKEN}",
-        },
-        method="POST",
-    )
-    resp = urllib.request.urlopen(req, timeout=15)
-    return json.loads(resp.read().decode("utf-8"))
+    return _slack_post(endpoint, json_dumps(payload_dict), "application/json; charset=utf-8")
 
 
 def slack_api_form(endpoint, params):
     """POST form-encoded data to a Slack Web API endpoint. Returns parsed response."""
     data = urllib.parse.urlencode(params).encode("utf-8")
-    req = urllib.request.Request(
-        f"https://slack.com/api/{endpoint}",
-        data=data,
-        headers={
-            "Content-Type": "application/x-www-form-urlencoded",
-            "Authorization": f"Bearer {SLACK_BOT_TOKEN}",
-        },
-        method="POST",
-    )
-    resp = urllib.request.urlopen(req, timeout=15)
-    return json.loads(resp.read().decode("utf-8"))
+    return _slack_post(endpoint, data, "application/x-www-form-urlencoded")
+
+
+def slack_api_stream(endpoint, params, path):
+    """POST form-encoded data to a Slack Web API endpoint and yield each object
+    under *path* (an ijson prefix such as "messages.item") as it is parsed.
+    Falls back to a full parse when ijson isn't installed.
+    Raises RuntimeError if Slack reports an error.
+    """
+    if ijson is None:
+        result = slack_api_form(endpoint, params)
+        if not result.get("ok"):
+            raise RuntimeError(result.get("error", result))
+        node = result
+        for key in path.split(".")[:-1]:
+            node = node.get(key, {})
+        yield from node
+        return
+
+    data = urllib.parse.urlencode(params).encode("utf-8")
+    resp = _slack_request(endpoint, data, "application/x-www-form-urlencoded")
+    try:
+        builder = None
+        for prefix, event, value in ijson.parse(resp):
+            if builder is not None:
+                builder.event(event, value)
+                if prefix == path and event == "end_map":
+                    yield builder.value
+                    builder = None
+            elif prefix == path and event == "start_map":
+                builder = ijson.ObjectBuilder()
+                builder.event(event, value)
+            elif prefix == "error":
+                raise RuntimeError(value)
+    finally:
+        # Abandoned or failed mid-body — the connection can't be reused
+        if not resp.isclosed():
+            _close_conn()
 
 
 # ---------------------------------------------------------------------------
 # State tracking — one Slack thread per Cursor conversation
-# State format: { conversation_id: { "thread_ts": "...", "file_id": "..." } }
+# Stored in SQLite (WAL mode) so concurrent hook processes don't clobber
+# each other: threads(conversation_id, thread_ts, file_id, updated_at)
 # ---------------------------------------------------------------------------
 
-def _load_state():
+_DB = None
+
+
+def _db():
+    """Return the process-wide state DB connection, opening it on first use."""
+    global _DB
+    if _DB is None:
+        STATE_DIR.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(STATE_DB, timeout=10, isolation_level=None,
+                               check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA mmap_size=67108864")
+        conn.execute("PRAGMA cache_size=-4096")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS threads ("
+            " conversation_id TEXT PRIMARY KEY,"
+            " thread_ts TEXT,"
+            " file_id TEXT,"
+            " updated_at REAL)"
+        )
+        # Lets get_most_recent_thread read the newest row off the index
+        conn.execute("CREATE INDEX IF NOT EXISTS threads_thread_ts ON threads(thread_ts)")
+        _migrate_json_state(conn)
+        _DB = conn
+    return _DB
+
+
+def _migrate_json_state(conn):
+    """One-shot import of the legacy threads.json into the DB."""
     try:
-        data = json.loads(STATE_FILE.read_text())
-        # Migrate old format (conversation_id -> thread_ts string)
-        migrated = {}
-        for k, v in data.items():
-            if isinstance(v, str):
-                migrated[k] = {"thread_ts": v}
-            else:
-                migrated[k] = v
-        return migrated
+        data = json_loads(STATE_FILE.read_bytes())
+    except FileNotFoundError:
+        return
     except Exception:
-        return {}
+        data = None
+    if not isinstance(data, dict):
+        # Unreadable or not a mapping — set it aside so we don't retry each open
+        try:
+            STATE_FILE.rename(STATE_FILE.with_suffix(".json.invalid"))
+        except OSError:
+            pass
+        log(f"Skipped migrating {STATE_FILE.name}: not a JSON object")
+        return
+
+    def _str_or_none(value):
+        return value if isinstance(value, str) else None
+
+    now = time.time()
+    rows = []
+    for cid, entry in data.items():
+        # Old format: conversation_id -> thread_ts string
+        if isinstance(entry, str):
+            entry = {"thread_ts": entry}
+        elif not isinstance(entry, dict):
+            continue
+        rows.append((cid, _str_or_none(entry.get("thread_ts")),
+                     _str_or_none(entry.get("file_id")), now))
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.executemany(
+            "INSERT OR IGNORE INTO threads(conversation_id, thread_ts, file_id, updated_at)"
+            " VALUES (?, ?, ?, ?)",
+            rows,
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    try:
+        STATE_FILE.rename(STATE_FILE.with_suffix(".json.migrated"))
+    except FileNotFoundError:
+        pass  # another hook process migrated it concurrently
+    log(f"Migrated {len(rows)} conversations from {STATE_FILE.name} to {STATE_DB.name}")
+
+
+def _get_field(conversation_id, column):
+    try:
+        row = _db().execute(
+            f"SELECT {column} FROM threads WHERE conversation_id = ?",
+            (conversation_id,),
+        ).fetchone()
+    except (sqlite3.Error, OSError) as e:
+        log(f"Thread state read failed ({column}): {e}")
+        return None
+    return row[0] if row else None
 
 
-def _save_state(state):
-    STATE_FILE.parent.mkdir(parents=True, exist_ok=True)
-    # Keep only the last 100 conversations
-    if len(state) > 100:
-        keys = sorted(state, key=lambda k: state[k].get("thread_ts", ""))
-        for k in keys[:-100]:
-            del state[k]
-    STATE_FILE.write_text(json.dumps(state))
+# conversation_id -> thread_ts mappings already confirmed by this process
+_THREAD_TS_CACHE = {}
 
 
 def get_thread_ts(conversation_id):
     """Return the Slack thread_ts for a conversation, or None."""
-    entry = _load_state().get(conversation_id, {})
-    return entry.get("thread_ts")
+    ts = _THREAD_TS_CACHE.get(conversation_id)
+    if ts is None:
+        ts = _get_field(conversation_id, "thread_ts")
+        if ts is not None:
+            _THREAD_TS_CACHE[conversation_id] = ts
+    return ts
 
 
 def get_transcript_file_id(conversation_id):
     """Return the previously uploaded transcript file_id, or None."""
-    entry = _load_state().get(conversation_id, {})
-    return entry.get("file_id")
+    return _get_field(conversation_id, "file_id")
+
+
+_CONVERSATION_FIELDS = ("thread_ts", "file_id")
+
+
+def save_conversation(conversation_id, **fields):
+    """Store one or more of thread_ts / file_id for a conversation in a
+    single upsert.
+    """
+    unknown = set(fields) - set(_CONVERSATION_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown conversation fields: {', '.join(sorted(unknown))}")
+    columns = [c for c in _CONVERSATION_FIELDS if c in fields]
+    if not columns:
+        return
+
+    conn = _db()
+    conn.execute(
+        f"INSERT INTO threads(conversation_id, {', '.join(columns)}, updated_at)"
+        f" VALUES (?, {', '.join('?' for _ in columns)}, ?)"
+        " ON CONFLICT(conversation_id) DO UPDATE SET "
+        + "".join(f"{c} = excluded.{c}, " for c in columns)
+        + "updated_at = excluded.updated_at",
+        (conversation_id, *(fields[c] for c in columns), time.time()),
+    )
+    if "thread_ts" in fields:
+        _THREAD_TS_CACHE[conversation_id] = fields["thread_ts"]
+        # Keep only the most recent conversations
+        conn.execute(
+            "DELETE FROM threads WHERE conversation_id NOT IN"
+            " (SELECT conversation_id FROM threads ORDER BY thread_ts DESC LIMIT ?)",
+            (MAX_CONVERSATIONS,),
+        )
 
 
 def save_thread_ts(conversation_id, ts):
     """Store the thread_ts for a conversation."""
-    state = _load_state()
-    if conversation_id not in state:
-        state[conversation_id] = {}
-    state[conversation_id]["thread_ts"] = ts
-    _save_state(state)
+    save_conversation(conversation_id, thread_ts=ts)
 
 
 def save_transcript_file_id(conversation_id, file_id):
     """Store the transcript file_id for a conversation."""
-    state = _load_state()
-    if conversation_id not in state:
-        state[conversation_id] = {}
-    state[conversation_id]["file_id"] = file_id
-    _save_state(state)
+    save_conversation(conversation_id, file_id=file_id)
 
 
 # ---------------------------------------------------------------------------
 # Chat title extraction
 # ---------------------------------------------------------------------------
 
+_USER_QUERY_START = b"<user_query>"
+_USER_QUERY_END = b"</user_query>"
+_TITLE_CHUNK_SIZE = 64 * 1024
+_MAX_QUERY_BYTES = 200_000  # only the first line is used; don't buffer more
+
+
+def _read_first_user_query(f):
+    """Return the raw bytes of the first <user_query> in binary file *f*,
+    truncated to _MAX_QUERY_BYTES, or None if there's no complete query.
+    Each chunk is searched once (plus a tag-sized overlap), so this is
+    linear in the bytes read.
+    """
+    # Find the opening tag, keeping just enough tail to catch a split tag
+    buf = b""
+    start = -1
+    while start == -1:
+        chunk = f.read(_TITLE_CHUNK_SIZE)
+        if not chunk:
+            return None
+        buf = buf[-(len(_USER_QUERY_START) - 1):] + chunk
+        start = buf.find(_USER_QUERY_START)
+
+    # Collect the query, searching only new bytes for the closing tag
+    query = bytearray(buf[start + len(_USER_QUERY_START):])
+    search_from = 0
+    while True:
+        end = query.find(_USER_QUERY_END, search_from)
+        if end != -1:
+            return bytes(query[:end])
+        if len(query) >= _MAX_QUERY_BYTES:
+            # Long query — its first line is all the title needs
+            return bytes(query[:_MAX_QUERY_BYTES])
+        chunk = f.read(_TITLE_CHUNK_SIZE)
+        if not chunk:
+            return None
+        search_from = max(0, len(query) - (len(_USER_QUERY_END) - 1))
+        query += chunk
+
+
 def extract_chat_title(transcript_path):
-    """Extract the first user query from the transcript to use as thread title."""
+    """Extract the first user query from the transcript to use as thread title.
+    Reads the transcript in chunks and stops at the first complete query.
+    """
     if not transcript_path or not os.path.isfile(transcript_path):
         return None
     try:
-        with open(transcript_path, "r", encoding="utf-8", errors="replace") as f:
-            content = f.read()
-        start_tag = "<user_query>"
-        end_tag = "</user_query>"
-        start = content.find(start_tag)
-        if start == -1:
-            return None
-        start += len(start_tag)
-        end = content.find(end_tag, start)
-        if end == -1:
+        with open(transcript_path, "rb") as f:
+            raw = _read_first_user_query(f)
+        if raw is None:
             return None
-        query = content[start:end].strip()
+        query = raw.decode("utf-8", errors="replace").strip()
         first_line = query.split("\n")[0].strip()
         if len(first_line) > 150:
             first_line = first_line[:147] + "..."
@@ -168,16 +449,16 @@ def ensure_thread(conversation_id, transcript_path=None):
     Creates one using the chat title if it doesn't exist yet.
     Returns the thread_ts.
     """
-    thread_ts = get_thread_ts(conversation_id)
-    if thread_ts:
-        return thread_ts
+    try:
+        thread_ts = get_thread_ts(conversation_id)
+        if thread_ts:
+            return thread_ts
 
-    title = extract_chat_title(transcript_path) if transcript_path else None
-    if not title:
-        title = "Cursor Agent Session"
-    message = f":thread: *{title}*"
+        title = extract_chat_title(transcript_path) if transcript_path else None
+        if not title:
+            title = "Cursor Agent Session"
+        message = f":thread: *{title}*"
 
-    try:
         result = slack_api_json("chat.postMessage", {
             "channel": SLACK_CHANNEL_ID,
             "text": message,
@@ -187,8 +468,12 @@ def ensure_thread(conversation_id, transcript_path=None):
             return None
         ts = result.get("ts")
         if ts:
-            save_thread_ts(conversation_id, ts)
             log(f"Created thread for {conversation_id}: {ts}")
+            try:
+                save_thread_ts(conversation_id, ts)
+            except (sqlite3.Error, OSError) as e:
+                # Still reply in the new thread; only later lookups miss it
+                log(f"Failed to save thread_ts for {conversation_id}: {e}")
         return ts
     except Exception as e:
         log(f"chat.postMessage (thread start) exception: {e}")
@@ -200,6 +485,9 @@ def post_message(text, conversation_id, transcript_path=None):
     Creates the thread first if it doesn't exist yet.
     Returns the thread_ts.
     """
+    # The reply needs the root's ts, so these two posts can't overlap; both
+    # go over the same keep-alive connection and the ts is passed straight
+    # through rather than re-read from state.
     thread_ts = ensure_thread(conversation_id, transcript_path)
 
     try:
@@ -238,52 +526,84 @@ def get_bot_user_id():
     return None
 
 
+def get_cached_bot_user_id():
+    """Like get_bot_user_id, but cached on disk per bot token so restarts
+    don't need an auth.test round-trip. Returns the user_id string, or None.
+    """
+    token_hash = hashlib.sha256(SLACK_BOT_TOKEN.encode("utf-8")).hexdigest()[:8]
+    try:
+        cached = json_loads(BOT_CACHE_FILE.read_bytes())
+        if cached.get("token_hash") == token_hash and cached.get("user_id"):
+            return cached["user_id"]
+    except Exception:
+        pass
+
+    user_id = get_bot_user_id()
+    if user_id:
+        try:
+            atomic_write(BOT_CACHE_FILE, json_dumps({"token_hash": token_hash, "user_id": user_id}))
+        except Exception as e:
+            log(f"Failed to cache bot user ID: {e}")
+    return user_id
+
+
 # ---------------------------------------------------------------------------
 # Thread replies (reading messages back from Slack)
 # ---------------------------------------------------------------------------
 
+# The only message fields the reply listener reads
+REPLY_FIELDS = ("ts", "bot_id", "user", "text")
+
+
 def get_thread_replies(thread_ts, oldest=None):
-    """Fetch replies to a Slack thread.
+    """Yield replies to a Slack thread as they are parsed from the response.
     Requires the channels:history (public) or groups:history (private) scope.
 
     Args:
         thread_ts: The thread's root message timestamp.
-        oldest: Only return messages newer than this timestamp (inclusive).
+        oldest: Only yield messages newer than this timestamp.
+
+    Yields:
+        Message dicts containing only the REPLY_FIELDS keys that are present.
+        Yields nothing further on failure.
 
-    Returns:
-        A list of message dicts, or an empty list on failure.
+    Raises:
+        SlackRateLimited: Slack rejected the request with HTTP 429.
     """
+    # Slack has no field selector for conversations.replies; the listener
+    # pages forward from oldest, so a small page is enough.
     params = {
         "channel": SLACK_CHANNEL_ID,
         "ts": thread_ts,
-        "limit": 50,
+        "limit": 20,
+        "include_all_metadata": "false",
     }
     if oldest:
         params["oldest"] = oldest
     try:
-        result = slack_api_form("conversations.replies", params)
-        if result.get("ok"):
-            return result.get("messages", [])
-        log(f"conversations.replies error: {result.get('error', result)}")
+        for msg in slack_api_stream("conversations.replies", params, "messages.item"):
+            # oldest is inclusive on Slack's side
+            if oldest and msg.get("ts", "") <= oldest:
+                continue
+            yield {k: msg[k] for k in REPLY_FIELDS if k in msg}
+    except SlackRateLimited:
+        raise
     except Exception as e:
         log(f"conversations.replies exception: {e}")
-    return []
 
 
 def get_most_recent_thread():
     """Return (conversation_id, thread_ts) for the most recently created thread.
     Returns (None, None) if no threads exist.
     """
-    state = _load_state()
-    if not state:
+    try:
+        row = _db().execute(
+            "SELECT conversation_id, thread_ts FROM threads"
+            " WHERE thread_ts IS NOT NULL ORDER BY thread_ts DESC LIMIT 1"
+        ).fetchone()
+    except (sqlite3.Error, OSError) as e:
+        log(f"Thread state read failed (most recent thread): {e}")
         return None, None
-    latest_cid = None
-    latest_ts = "0"
-    for cid, entry in state.items():
-        ts = entry.get("thread_ts", "0") if isinstance(entry, dict) else entry
-        if ts > latest_ts:
-            latest_ts = ts
-            latest_cid = cid
-    if latest_cid:
-        return latest_cid, latest_ts
+    if row:
+        return row[0], row[1]
     return None, None
@@ -4,8 +4,12 @@
 # Slack Reply Listener — Polls Slack for human replies and injects into Cursor
 # =============================================================================
 # Background daemon that watches the most recent Cursor conversation thread
-# in Slack for human replies, then uses macOS AppleScript to paste them into
-# the Cursor chat input.
+# in Slack for human replies, then pastes them into the Cursor chat input
+# using pyobjc (AppKit + Quartz) if installed, else macOS AppleScript.
+#
+# If slack_sdk is installed and SLACK_APP_TOKEN (xapp-...) is configured, the
+# listener receives replies over a Socket Mode WebSocket as they are posted.
+# Otherwise it falls back to polling conversations.replies every --interval.
 #
 # Usage:
 #   slack_listener.py start   [--interval N] [--shortcut KEY]
@@ -16,31 +20,75 @@
 #   - macOS (uses osascript for keyboard automation)
 #   - Slack bot token with channels:history scope
 #   - Accessibility permissions for the terminal app running the listener
+#   - Socket Mode only: app-level token with connections:write, and the
+#     message.channels (or message.groups) bot event subscription
 # =============================================================================
 
 import argparse
-import json
 import os
+import plistlib
 import signal
 import subprocess
 import sys
+import threading
 import time
 from pathlib import Path
 
 sys.path.insert(0, Path(__file__).resolve().parent.as_posix())
 from slack_common import (
-    get_bot_user_id,
+    SLACK_APP_TOKEN,
+    SLACK_BOT_TOKEN,
+    SLACK_CHANNEL_ID,
+    SlackRateLimited,
+    atomic_write,
+    get_cached_bot_user_id,
     get_most_recent_thread,
     get_thread_replies,
+    json_dumps,
+    json_loads,
     log,
 )
 
+try:
+    from slack_sdk import WebClient
+    from slack_sdk.socket_mode import SocketModeClient
+    from slack_sdk.socket_mode.response import SocketModeResponse
+except ImportError:
+    SocketModeClient = None
+
 STATE_DIR = Path.home() / ".cursor" / "hooks" / "state"
 LISTENER_STATE_FILE = STATE_DIR / "listener.json"
 PID_FILE = STATE_DIR / "listener.pid"
+INJECT_SCRIPT_FILE = STATE_DIR / "inject.applescript"
 
 DEFAULT_INTERVAL = 5  # seconds between polls
+MAX_POLL_INTERVAL = 60  # idle threads back off exponentially up to this
 DEFAULT_SHORTCUT = "l"  # Cmd+<key> to open/focus chat input
+STATE_FLUSH_INTERVAL = 30  # min seconds between listener.json writes while polling
+
+CURSOR_BUNDLE_ID = "com.todesktop.230313mzl4w4u92"
+ACTIVATE_DELAY = 0.5  # seconds for Cursor to come to the front
+FOCUS_DELAY = 0.3  # seconds for the chat input to take focus
+PASTE_DELAY = 0.1  # seconds for the paste to land before Enter
+
+# macOS virtual key codes for the native injection path. These are physical
+# key positions, so they only mean Cmd+V etc. on US-style layouts.
+KEY_CODES = {
+    "a": 0, "s": 1, "d": 2, "f": 3, "h": 4, "g": 5, "z": 6, "x": 7, "c": 8,
+    "v": 9, "b": 11, "q": 12, "w": 13, "e": 14, "r": 15, "y": 16, "t": 17,
+    "1": 18, "2": 19, "3": 20, "4": 21, "6": 22, "5": 23, "=": 24, "9": 25,
+    "7": 26, "-": 27, "8": 28, "0": 29, "]": 30, "o": 31, "u": 32, "[": 33,
+    "i": 34, "p": 35, "l": 37, "j": 38, "'": 39, "k": 40, ";": 41, "\\": 42,
+    ",": 43, "/": 44, "n": 45, "m": 46, ".": 47, "`": 50,
+}
+KEY_RETURN = 36
+HITOOLBOX_PREFS = Path.home() / "Library" / "Preferences" / "com.apple.HIToolbox.plist"
+US_KEY_LAYOUTS = {
+    "com.apple.keylayout.US",
+    "com.apple.keylayout.ABC",
+    "com.apple.keylayout.USExtended",
+    "com.apple.keylayout.USInternational-PC",
+}
 
 
 # ---------------------------------------------------------------------------
@@ -49,49 +97,104 @@ DEFAULT_SHORTCUT = "l"  # Cmd+<key> to open/focus chat input
 
 def _load_listener_state():
     try:
-        return json.loads(LISTENER_STATE_FILE.read_text())
+        return json_loads(LISTENER_STATE_FILE.read_bytes())
     except Exception:
         return {}
 
 
 def _save_listener_state(state):
-    LISTENER_STATE_FILE.parent.mkdir(parents=True, exist_ok=True)
-    LISTENER_STATE_FILE.write_text(json.dumps(state))
+    atomic_write(LISTENER_STATE_FILE, json_dumps(state))
 
 
 # ---------------------------------------------------------------------------
-# AppleScript injection
+# Chat injection — native Quartz events via pyobjc, else AppleScript
 # ---------------------------------------------------------------------------
 
-def inject_message(message, shortcut_key):
-    """Use AppleScript to paste *message* into the Cursor chat input.
+# (AppKit, Quartz) once imported; False if pyobjc isn't installed. Imported
+# on first use rather than at module load, because CoreFoundation can abort
+# in a child that forked (cmd_start's double fork) after it was loaded.
+_PYOBJC = None
 
-    Steps:
-      1. Set the macOS clipboard to the message text.
-      2. Activate the Cursor application window.
-      3. Press Cmd+<shortcut_key> to open/focus the chat input.
-      4. Press Cmd+V to paste.
-      5. Press Enter to send.
-    """
-    # Escape backslashes and double-quotes for AppleScript string literal
-    escaped = message.replace("\\", "\\\\").replace('"', '\\"')
-
-    script = (
-        f'set the clipboard to "{escaped}"\n'
-        f'tell application "Cursor" to activate\n'
-        f"delay 0.5\n"
-        f'tell application "System Events"\n'
-        f'    keystroke "{shortcut_key}" using command down\n'
-        f"    delay 0.3\n"
-        f'    keystroke "v" using command down\n'
-        f"    delay 0.1\n"
-        f"    key code 36\n"  # Enter
-        f"end tell\n"
-    )
 
+def _load_pyobjc():
+    global _PYOBJC
+    if _PYOBJC is None:
+        try:
+            import AppKit
+            import Quartz
+            _PYOBJC = (AppKit, Quartz)
+        except ImportError:
+            _PYOBJC = False
+    return _PYOBJC
+
+
+def _us_key_layout():
+    """Return True if the current keyboard layout is one KEY_CODES matches."""
+    try:
+        with open(HITOOLBOX_PREFS, "rb") as f:
+            prefs = plistlib.load(f)
+    except Exception:
+        return False
+    return prefs.get("AppleCurrentKeyboardLayoutInputSourceID") in US_KEY_LAYOUTS
+
+
+def _press_key(quartz, key_code, command=False):
+    for key_down in (True, False):
+        event = quartz.CGEventCreateKeyboardEvent(None, key_code, key_down)
+        if command:
+            quartz.CGEventSetFlags(event, quartz.kCGEventFlagMaskCommand)
+        quartz.CGEventPost(quartz.kCGHIDEventTap, event)
+
+
+def _inject_native(appkit, quartz, message, shortcut_key):
+    """Paste *message* into Cursor with AppKit + synthesized key events."""
+    apps = appkit.NSRunningApplication.runningApplicationsWithBundleIdentifier_(CURSOR_BUNDLE_ID)
+    if not apps:
+        log("Native injection skipped: Cursor is not running")
+        return
+
+    pasteboard = appkit.NSPasteboard.generalPasteboard()
+    pasteboard.clearContents()
+    pasteboard.setString_forType_(message, appkit.NSPasteboardTypeString)
+
+    apps[0].activateWithOptions_(appkit.NSApplicationActivateIgnoringOtherApps)
+    time.sleep(ACTIVATE_DELAY)
+    _press_key(quartz, KEY_CODES[shortcut_key.lower()], command=True)
+    time.sleep(FOCUS_DELAY)
+    _press_key(quartz, KEY_CODES["v"], command=True)
+    time.sleep(PASTE_DELAY)
+    _press_key(quartz, KEY_RETURN)
+    log(f"Injected Slack reply via Quartz events ({len(message)} chars)")
+
+
+# Static script; the message and shortcut key arrive as argv, so there's
+# nothing to escape and no per-call script construction.
+INJECT_SCRIPT = f"""on run argv
+    set the clipboard to (item 1 of argv)
+    tell application "Cursor" to activate
+    delay {ACTIVATE_DELAY}
+    tell application "System Events"
+        keystroke (item 2 of argv) using command down
+        delay {FOCUS_DELAY}
+        keystroke "v" using command down
+        delay {PASTE_DELAY}
+        key code {KEY_RETURN}
+    end tell
+end run
+"""
+
+
+def _write_inject_script():
+    atomic_write(INJECT_SCRIPT_FILE, INJECT_SCRIPT.encode("utf-8"))
+
+
+def _inject_applescript(message, shortcut_key):
+    """Paste *message* into Cursor by running the inject script via osascript."""
+    if not INJECT_SCRIPT_FILE.exists():
+        _write_inject_script()
     try:
         subprocess.run(
-            ["osascript", "-e", script],
+            ["osascript", str(INJECT_SCRIPT_FILE), message, shortcut_key],
             timeout=10,
             check=True,
             capture_output=True,
@@ -101,83 +204,264 @@ def inject_message(message, shortcut_key):
         log("AppleScript injection timed out")
     except subprocess.CalledProcessError as e:
         log(f"AppleScript injection failed: {e.stderr.decode(errors='replace')}")
+
+
+def inject_message(message, shortcut_key):
+    """Paste *message* into the Cursor chat input.
+
+    Steps:
+      1. Set the macOS clipboard to the message text.
+      2. Activate the Cursor application window.
+      3. Press Cmd+<shortcut_key> to open/focus the chat input.
+      4. Press Cmd+V to paste.
+      5. Press Enter to send.
+
+    Uses pyobjc (AppKit + Quartz) in-process when it's installed and a
+    US-style keyboard layout is active; otherwise shells out to osascript,
+    whose keystrokes are layout-aware.
+    """
+    try:
+        pyobjc = _load_pyobjc()
+        if pyobjc and shortcut_key.lower() in KEY_CODES and _us_key_layout():
+            _inject_native(*pyobjc, message, shortcut_key)
+        else:
+            _inject_applescript(message, shortcut_key)
     except Exception as e:
-        log(f"AppleScript injection error: {e}")
+        log(f"Chat injection error: {e}")
 
 
 # ---------------------------------------------------------------------------
-# Polling loop
+# Reply handling
 # ---------------------------------------------------------------------------
 
-def run_listener(interval, shortcut_key):
-    """Main polling loop. Runs until SIGTERM/SIGINT."""
-    STATE_DIR.mkdir(parents=True, exist_ok=True)
-    PID_FILE.write_text(str(os.getpid()))
+# _process_reply results (truthy when the last-seen ts was advanced)
+REPLY_SKIPPED = 0
+REPLY_ADVANCED = 1  # bot / own / empty message, nothing injected
+REPLY_INJECTED = 2  # human reply pasted into Cursor
 
-    # Resolve the bot's own user ID so we can filter its messages
-    bot_user_id = get_bot_user_id()
-    log(f"Slack listener started (pid={os.getpid()}, interval={interval}s, "
-        f"shortcut=Cmd+{shortcut_key}, bot_user_id={bot_user_id})")
 
-    listener_state = _load_listener_state()
+def _process_reply(msg, thread_ts, listener_state, bot_user_id, shortcut_key):
+    """Inject *msg* into Cursor if it is a new human reply in *thread_ts*.
+    Only the REPLY_FIELDS keys of *msg* (ts, bot_id, user, text) are read, so
+    it may be a trimmed conversations.replies message or a raw message event.
+    Returns REPLY_SKIPPED, REPLY_ADVANCED or REPLY_INJECTED.
+    """
+    msg_ts = msg.get("ts", "")
 
-    # Graceful shutdown
-    running = True
+    # Use last-seen ts for this thread, defaulting to thread_ts itself
+    # (so we skip the root message)
+    last_seen = listener_state.get(thread_ts, thread_ts)
 
-    def _handle_signal(signum, _frame):
-        nonlocal running
-        running = False
-        log(f"Slack listener received signal {signum}, shutting down")
+    # Skip already-processed messages (oldest is inclusive)
+    if msg_ts <= last_seen:
+        return REPLY_SKIPPED
 
-    signal.signal(signal.SIGTERM, _handle_signal)
-    signal.signal(signal.SIGINT, _handle_signal)
+    # Skip the thread root message
+    if msg_ts == thread_ts:
+        return REPLY_SKIPPED
 
-    try:
-        while running:
-            _conversation_id, thread_ts = get_most_recent_thread()
-            if not thread_ts:
-                time.sleep(interval)
-                continue
+    # Skip bot messages
+    if msg.get("bot_id"):
+        listener_state[thread_ts] = msg_ts
+        return REPLY_ADVANCED
+    if bot_user_id and msg.get("user") == bot_user_id:
+        listener_state[thread_ts] = msg_ts
+        return REPLY_ADVANCED
+
+    text = msg.get("text", "").strip()
+    if not text:
+        listener_state[thread_ts] = msg_ts
+        return REPLY_ADVANCED
 
-            # Use last-seen ts for this thread, defaulting to thread_ts itself
-            # (so we skip the root message on first poll)
-            last_seen = listener_state.get(thread_ts, thread_ts)
+    log(f"New human reply in thread {thread_ts}: "
+        f"{text[:80]}{'...' if len(text) > 80 else ''}")
+    inject_message(text, shortcut_key)
 
-            replies = get_thread_replies(thread_ts, oldest=last_seen)
+    listener_state[thread_ts] = msg_ts
+    return REPLY_INJECTED
+
+
+# ---------------------------------------------------------------------------
+# Polling loop (fallback when Socket Mode is unavailable)
+# ---------------------------------------------------------------------------
 
+def _run_polling(interval, shortcut_key, bot_user_id, listener_state, stop):
+    """Poll the most recent thread until *stop* is set.
+    Polls every *interval* seconds while the thread is active, doubling the
+    wait (up to MAX_POLL_INTERVAL) for each poll that finds nothing new.
+    Listener state is written right after each injected reply, so a crash
+    can't re-inject it; other advances are written at most every
+    STATE_FLUSH_INTERVAL seconds, and run_listener flushes on exit.
+    """
+    dirty = False
+    last_flush = time.monotonic()
+    backoff = interval
+    polled_thread_ts = None
+    while not stop.is_set():
+        _conversation_id, thread_ts = get_most_recent_thread()
+        if not thread_ts:
+            stop.wait(interval)
+            continue
+
+        # A new conversation is likely to get replies soon
+        if thread_ts != polled_thread_ts:
+            backoff = interval
+            polled_thread_ts = thread_ts
+
+        last_seen = listener_state.get(thread_ts, thread_ts)
+        replies = get_thread_replies(thread_ts, oldest=last_seen)
+
+        got_new = False
+        try:
             for msg in replies:
-                msg_ts = msg.get("ts", "")
+                result = _process_reply(msg, thread_ts, listener_state, bot_user_id, shortcut_key)
+                if result == REPLY_INJECTED:
+                    _save_listener_state(listener_state)
+                    dirty = False
+                    last_flush = time.monotonic()
+                    got_new = True
+                elif result:
+                    dirty = True
+                    got_new = True
+        except SlackRateLimited as e:
+            log(f"{e}; pausing polls")
+            stop.wait(max(e.retry_after, backoff))
+            continue
+
+        if dirty and time.monotonic() - last_flush >= STATE_FLUSH_INTERVAL:
+            _save_listener_state(listener_state)
+            dirty = False
+            last_flush = time.monotonic()
 
-                # Skip already-processed messages (oldest is inclusive)
-                if msg_ts <= last_seen:
-                    continue
+        backoff = interval if got_new else min(backoff * 2, max(interval, MAX_POLL_INTERVAL))
+        stop.wait(backoff)
 
-                # Skip the thread root message
-                if msg_ts == thread_ts:
-                    continue
 
-                # Skip bot messages
-                if msg.get("bot_id"):
-                    listener_state[thread_ts] = msg_ts
-                    continue
-                if bot_user_id and msg.get("user") == bot_user_id:
-                    listener_state[thread_ts] = msg_ts
-                    continue
+# ---------------------------------------------------------------------------
+# Socket Mode (push) loop
+# ---------------------------------------------------------------------------
 
-                text = msg.get("text", "").strip()
-                if not text:
-                    listener_state[thread_ts] = msg_ts
-                    continue
+# Message event subtypes that never carry a new human reply. Others, such as
+# file_share and thread_broadcast, are replies polling would inject too.
+SKIPPED_SUBTYPES = {"message_changed", "message_deleted", "bot_message"}
 
-                log(f"New human reply in thread {thread_ts}: "
-                    f"{text[:80]}{'...' if len(text) > 80 else ''}")
-                inject_message(text, shortcut_key)
 
-                listener_state[thread_ts] = msg_ts
+def _catch_up(shortcut_key, bot_user_id, listener_state):
+    """Process replies posted to the most recent thread while we weren't
+    connected (Socket Mode only delivers events from connect onward).
+    """
+    _conversation_id, thread_ts = get_most_recent_thread()
+    if not thread_ts:
+        return
+    last_seen = listener_state.get(thread_ts, thread_ts)
+    try:
+        for msg in get_thread_replies(thread_ts, oldest=last_seen):
+            if _process_reply(msg, thread_ts, listener_state, bot_user_id, shortcut_key):
+                _save_listener_state(listener_state)
+    except SlackRateLimited as e:
+        log(f"{e}; skipping catch-up")
 
-            _save_listener_state(listener_state)
-            time.sleep(interval)
+
+def _run_socket_mode(shortcut_key, bot_user_id, listener_state, stop):
+    """Receive thread replies over a Socket Mode WebSocket until *stop* is set.
+    Returns False without blocking if the connection can't be established.
+    """
+    lock = threading.Lock()
+
+    def _on_request(client, req):
+        if req.type != "events_api":
+            return
+        client.send_socket_mode_response(SocketModeResponse(envelope_id=req.envelope_id))
+
+        event = req.payload.get("event", {})
+        if event.get("type") != "message" or event.get("subtype") in SKIPPED_SUBTYPES:
+            return
+        if event.get("channel") != SLACK_CHANNEL_ID:
+            return
+        _conversation_id, thread_ts = get_most_recent_thread()
+        if not thread_ts or event.get("thread_ts") != thread_ts:
+            return
+
+        with lock:
+            if _process_reply(event, thread_ts, listener_state, bot_user_id, shortcut_key):
+                _save_listener_state(listener_state)
+
+    # One worker so events are handled in arrival order; with more, a later
+    # reply could advance last-seen first and get an earlier one dropped.
+    client = SocketModeClient(
+        app_token=SLACK_APP_TOKEN,
+        web_client=WebClient(token=SLACK_BOT_TOKEN),
+        concurrency=1,
+    )
+    client.socket_mode_request_listeners.append(_on_request)
+
+    # Hold the lock until catch-up is done so live events queue behind it
+    # and last-seen only ever moves forward in ts order.
+    with lock:
+        try:
+            client.connect()
+        except Exception as e:
+            log(f"Socket Mode connect failed: {e}")
+            client.close()
+            return False
+        log("Socket Mode connected")
+        _catch_up(shortcut_key, bot_user_id, listener_state)
+
+    try:
+        while not stop.wait(1):
+            pass
+    finally:
+        client.disconnect()
+        client.close()
+    return True
+
+
+# ---------------------------------------------------------------------------
+# Listener main
+# ---------------------------------------------------------------------------
+
+def run_listener(interval, shortcut_key):
+    """Main listener loop. Runs until SIGTERM/SIGINT."""
+    STATE_DIR.mkdir(parents=True, exist_ok=True)
+    pid = os.getpid()
+    try:
+        start_time = _process_start_time(pid)
+    except (OSError, subprocess.TimeoutExpired):
+        start_time = None  # _read_pid falls back to a liveness check
+    atomic_write(PID_FILE, json_dumps({"pid": pid, "start_time": start_time}))
+    _write_inject_script()
+
+    use_socket_mode = SocketModeClient is not None and bool(SLACK_APP_TOKEN)
+
+    # Resolve the bot's own user ID so we can filter its messages
+    bot_user_id = get_cached_bot_user_id()
+    log(f"Slack listener started (pid={os.getpid()}, "
+        f"mode={'socket' if use_socket_mode else f'polling every {interval}s'}, "
+        f"shortcut=Cmd+{shortcut_key}, bot_user_id={bot_user_id})")
+
+    listener_state = _load_listener_state()
+
+    # Graceful shutdown
+    stop = threading.Event()
+
+    def _handle_signal(signum, _frame):
+        log(f"Slack listener received signal {signum}, shutting down")
+        stop.set()
+
+    signal.signal(signal.SIGTERM, _handle_signal)
+    signal.signal(signal.SIGINT, _handle_signal)
+
+    try:
+        if not use_socket_mode or not _run_socket_mode(
+                shortcut_key, bot_user_id, listener_state, stop):
+            if use_socket_mode:
+                log(f"Falling back to polling every {interval}s")
+            _run_polling(interval, shortcut_key, bot_user_id, listener_state, stop)
     finally:
+        try:
+            _save_listener_state(listener_state)
+        except Exception as e:
+            log(f"Failed to save listener state: {e}")
         try:
             PID_FILE.unlink(missing_ok=True)
         except Exception:
@@ -189,15 +473,58 @@ def run_listener(interval, shortcut_key):
 # Daemon helpers (start / stop / status)
 # ---------------------------------------------------------------------------
 
-def _read_pid():
-    """Return the PID from the pidfile, or None."""
+def _process_start_time(pid):
+    """Return the start time ps reports for *pid*, or None if it isn't running.
+    Runs ps in the C locale and UTC so the value doesn't depend on the
+    calling shell. Raises OSError / TimeoutExpired if ps itself fails.
+    """
+    result = subprocess.run(
+        ["ps", "-o", "lstart=", "-p", str(pid)],
+        timeout=5,
+        capture_output=True,
+        text=True,
+        env={**os.environ, "LC_ALL": "C", "TZ": "UTC0"},
+    )
+    return result.stdout.strip() or None
+
+
+def _pid_alive(pid):
     try:
-        pid = int(PID_FILE.read_text().strip())
-        # Check if process is still alive
         os.kill(pid, 0)
-        return pid
-    except (FileNotFoundError, ValueError, ProcessLookupError, PermissionError):
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+
+def _read_pid():
+    """Return the listener's PID from the pidfile, or None.
+    The pidfile records the process start time too, so a recycled PID that
+    now belongs to some other process is treated as stale and removed.
+    """
+    try:
+        info = json_loads(PID_FILE.read_bytes())
+        if isinstance(info, dict):
+            pid, start_time = int(info["pid"]), info.get("start_time")
+        else:
+            pid, start_time = int(info), None  # legacy pidfile: bare PID
+    except (FileNotFoundError, ValueError, KeyError, TypeError):
+        return None
+
+    try:
+        current = _process_start_time(pid)
+    except (OSError, subprocess.TimeoutExpired):
+        # Can't ask ps; don't discard a possibly-live listener's pidfile
+        return pid if _pid_alive(pid) else None
+
+    if current is None or (start_time and current != start_time):
+        try:
+            PID_FILE.unlink(missing_ok=True)
+        except Exception:
+            pass
         return None
+    return pid
 
 
 def cmd_start(args):
@@ -279,7 +606,8 @@ def main():
     p_start = sub.add_parser("start", help="Start the listener daemon")
     p_start.add_argument(
         "--interval", type=int, default=DEFAULT_INTERVAL,
-        help=f"Polling interval in seconds (default: {DEFAULT_INTERVAL})")
+        help=f"Polling interval in seconds when Socket Mode is unavailable "
+             f"(default: {DEFAULT_INTERVAL})")
     p_start.add_argument(
         "--shortcut", type=str, default=DEFAULT_SHORTCUT,
         help=f"Key for Cmd+<key> to focus chat input (default: {DEFAULT_SHORTCUT})")
@@ -17,6 +17,7 @@ CONFIG_FILE="$CURSOR_DIR/hooks/state/config.json"
 if [ -f "$CONFIG_FILE" ]; then
     SLACK_BOT_TOKEN="${SLACK_BOT_TOKEN:-$(python3 -c "import json; print(json.load(open('$CONFIG_FILE')).get('SLACK_BOT_TOKEN',''))" 2>/dev/null)}"
     SLACK_CHANNEL_ID="${SLACK_CHANNEL_ID:-$(python3 -c "import json; print(json.load(open('$CONFIG_FILE')).get('SLACK_CHANNEL_ID',''))" 2>/dev/null)}"
+    SLACK_APP_TOKEN="${SLACK_APP_TOKEN:-$(python3 -c "import json; print(json.load(open('$CONFIG_FILE')).get('SLACK_APP_TOKEN',''))" 2>/dev/null)}"
 fi
 
 # -------------------------------------------------------------------------
@@ -91,11 +92,14 @@ python3 -c "
 import json, pathlib, sys
 p = pathlib.Path('$CONFIG_FILE')
 p.parent.mkdir(parents=True, exist_ok=True)
-p.write_text(json.dumps({
+cfg = {
     'SLACK_BOT_TOKEN': sys.argv[1],
     'SLACK_CHANNEL_ID': sys.argv[2]
-}, indent=2))
-" "$SLACK_BOT_TOKEN" "$SLACK_CHANNEL_ID"
+}
+if sys.argv[3]:
+    cfg['SLACK_APP_TOKEN'] = sys.argv[3]
+p.write_text(json.dumps(cfg, indent=2))
+" "$SLACK_BOT_TOKEN" "$SLACK_CHANNEL_ID" "$SLACK_APP_TOKEN"
 echo "  Saved credentials to $CONFIG_FILE"
 
 # -------------------------------------------------------------------------
@@ -129,6 +133,8 @@ echo ""
 echo "The Slack reply listener lets you type in a Slack thread and have the"
 echo "message automatically pasted into Cursor's chat input (macOS only)."
 echo "Requires the channels:history scope on your Slack bot token."
+echo "With slack_sdk installed and SLACK_APP_TOKEN set, replies arrive via"
+echo "Socket Mode instead of polling."
 echo ""
 printf "Start the Slack reply listener? (y/N): "
 read -r LISTENER_CHOICE
@@ -147,7 +153,7 @@ echo ""
 echo "Restart Cursor to activate hooks."
 echo ""
 echo "Debug logs:   /tmp/cursor-slack-hook.log"
-echo "Thread state: ~/.cursor/hooks/state/threads.json"
+echo "Thread state: ~/.cursor/hooks/state/threads.db"
 echo ""
 echo "Slack reply listener (macOS):"
 echo "  Start:   python3 ~/.cursor/hooks/slack_listener.py start"